@@ -1,12 +1,20 @@
+import argparse
+import gzip
+import mmap
 import os
+import pickle
+import struct
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple
 
 import cv2
+import msgspec
 import numpy as np
 import requests
-from pydantic import BaseModel
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 """
 
@@ -76,67 +84,281 @@ to the site's frontend.
 """
 class AudibleClient:
     def get_user_library(self) -> List[Dict[str, Any]]:
-        return [{"title": f"Audiobook {i}", "author": f"Author {i}", "date_added": datetime.now() - timedelta(days=i)} for i in range(10)]
+        now = datetime.now()
+        return [{"title": f"Audiobook {i}", "author": f"Author {i}", "date_added": now - timedelta(days=i)} for i in range(10)]
 
 class SpotifyClient:
     def get_recently_played(self) -> List[Dict[str, Any]]:
-        return [{"track": f"Song {i}", "artist": f"Artist {i}", "played_at": datetime.now() - timedelta(hours=i)} for i in range(5)]
+        now = datetime.now()
+        return [{"track": f"Song {i}", "artist": f"Artist {i}", "played_at": now - timedelta(hours=i)} for i in range(5)]
 
 # Computer Vision with OpenCV
+def filter_boxes(rects: np.ndarray, min_w: float, min_h: float) -> np.ndarray:
+    return rects[(rects[:, 2] > min_w) & (rects[:, 3] > min_h)]
+
 class BookshelfScanner:
     def __init__(self):
+        cv2.setUseOptimized(True)
+        cv2.setNumThreads(os.cpu_count() or 1)
+        self.camera = None
+        self._grey_shape = None
+        self.seen_path = os.path.expanduser("~/.cache/bookshelf/seen.pkl")
+        self.seen = self._load_seen()
+        self._pending_seen: List[Tuple[int, float]] = []
+        # tall thin kernel joins broken vertical spine edges
+        self._spine_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (1, 15))
+        self._canny = None
+        if hasattr(cv2, "cuda") and cv2.cuda.getCudaEnabledDeviceCount() > 0:
+            self._gpu_gray = cv2.cuda_GpuMat()
+            self._canny = cv2.cuda.createCannyEdgeDetector(50, 150, 3, False)
+        self.release_buffers()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def open_camera(self):
         self.camera = cv2.VideoCapture(0)
-        self.last_scan = set()
+        self._grey_shape = None
+        # ask for single-channel frames; drivers that can't do GREY keep giving BGR
+        grey = cv2.VideoWriter_fourcc(*"GREY")
+        if self.camera.set(cv2.CAP_PROP_FOURCC, grey) and int(self.camera.get(cv2.CAP_PROP_FOURCC)) == grey:
+            # otherwise the backend converts GREY straight back to BGR
+            self.camera.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+            self._grey_shape = (int(self.camera.get(cv2.CAP_PROP_FRAME_HEIGHT)), int(self.camera.get(cv2.CAP_PROP_FRAME_WIDTH)))
+
+    def release(self):
+        # free /dev/video0 and the frame buffers between scans
+        if self.camera is not None:
+            self.camera.release()
+            self.camera = None
+        self.release_buffers()
+
+    def release_buffers(self):
+        self._frame = None
+        self._gray = self._blur = self._edges = None
+
+    def _ensure_buffers(self, shape):
+        if self._blur is None or self._blur.shape != shape:
+            self._gray = np.empty(shape, np.uint8)
+            self._blur = np.empty_like(self._gray)
+            self._edges = np.empty_like(self._gray)
+
+    def _load_seen(self) -> set:  # {(pHash, spine centre as a fraction of frame width)}
+        try:
+            with open(self.seen_path, "rb") as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return set()
+
+    def _save_seen(self):
+        os.makedirs(os.path.dirname(self.seen_path), exist_ok=True)
+        tmp = f"{self.seen_path}.tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(self.seen, f)
+        os.replace(tmp, self.seen_path)
 
     def capture_image(self) -> np.ndarray:
-        ret, frame = self.camera.read()
+        if self.camera is None:
+            self.open_camera()
+        ret = self.camera.grab()
+        if ret:
+            ret, self._frame = self.camera.retrieve(self._frame)
+        if not ret:
+            raise Exception("Bookshelf camera read failed")
+        frame = self._shape_frame(self._frame)
+        if frame is None:
+            # raw GREY buffer we can't lay out as an image; let the backend hand us BGR from now on
+            self.camera.set(cv2.CAP_PROP_CONVERT_RGB, 1)
+            self._grey_shape = None
+            return self.capture_image()
         return frame
 
-    def process_image(self, image: np.ndarray) -> List[str]:
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        edges = cv2.Canny(gray, 50, 150)
-        contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        
-        book_titles = []
-        for contour in contours:
-            x, y, w, h = cv2.boundingRect(contour)
-            if w > 50 and h > 200:
-                roi = gray[y:y+h, x:x+w]
-                title = f"Book {len(book_titles) + 1}"
-                book_titles.append(title)
+    def _shape_frame(self, frame: np.ndarray) -> Optional[np.ndarray]:
+        if not self._grey_shape or frame.ndim == 3:
+            return frame
+        h, w = self._grey_shape
+        if frame.shape == (h, w):
+            return frame
+        # unconverted frames come back as one flat row of Y bytes, possibly with padded rows
+        if frame.ndim == 2 and frame.shape[0] == 1 and frame.size % h == 0 and frame.size // h >= w:
+            return frame.reshape(h, -1)[:, :w]
+        return None
+
+    def process_image(self, image: np.ndarray) -> List[Tuple[int, float, np.ndarray]]:
+        # spines don't need full resolution, so work on a ~640px wide copy
+        scale = min(1.0, 640 / image.shape[1])
+        small = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1.0 else image
+        self._ensure_buffers(small.shape[:2])
+        gray = small if small.ndim == 2 else cv2.cvtColor(small, cv2.COLOR_BGR2GRAY, dst=self._gray)
+        blur = cv2.GaussianBlur(gray, (5, 5), 1.4, dst=self._blur)
+        if self._canny is not None:
+            self._gpu_gray.upload(blur)
+            edges = self._canny.detect(self._gpu_gray).download(self._edges)
+        else:
+            edges = cv2.Canny(blur, 50, 150, edges=self._edges, apertureSize=3, L2gradient=False)
+        closed = cv2.morphologyEx(edges, cv2.MORPH_CLOSE, self._spine_kernel, dst=edges)
+        contours, _ = cv2.findContours(closed, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_TC89_L1)
         
-        return book_titles
-
-    def get_new_books(self) -> List[str]:
-        current_books = set(self.process_image(self.capture_image()))
-        new_books = current_books - self.last_scan
-        self.last_scan = current_books
-        return list(new_books)
+        rects = np.fromiter(map(cv2.boundingRect, contours), dtype=np.dtype((np.int32, 4)), count=len(contours))
+        kept = filter_boxes(rects, 50 * scale, 200 * scale)
+
+        # fingerprint each spine so the same book keeps its identity across scans and restarts
+        # a list, not a dict: different books can share a pHash
+        spines = []
+        for box in kept:
+            x, y, w, h = box
+            key = int.from_bytes(cv2.img_hash.pHash(gray[y:y+h, x:x+w]).tobytes(), "little")
+            # box goes back in full-resolution coordinates so spine crops stay readable
+            spines.append((key, (x + w / 2) / gray.shape[1], np.rint(box / scale).astype(np.int32)))
+        return spines
+
+    def encode_spine(self, image: np.ndarray, box: np.ndarray) -> Optional[bytes]:
+        # LLaMA only needs an 8-bit crop to read the spine, so ship JPEG rather than raw pixels
+        x, y, w, h = box
+        roi = image[y:y+h, x:x+w]
+        if roi.ndim == 3:
+            roi = cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY)
+        ok, buf = cv2.imencode(".jpg", roi, [cv2.IMWRITE_JPEG_QUALITY, 70, cv2.IMWRITE_JPEG_OPTIMIZE, 1])
+        return buf.tobytes() if ok else None
+
+    def get_new_books(self, max_bits: int = 6, max_shift: float = 0.1) -> Dict[str, Optional[bytes]]:
+        # a spine counts as seen if a near-identical hash (lighting/noise tolerant) sits at roughly the same place on the shelf
+        seen_keys = np.fromiter((k for k, _ in self.seen), np.uint64, len(self.seen))
+        seen_centres = np.fromiter((c for _, c in self.seen), np.float64, len(self.seen))
+        new_books = {}
+        self._pending_seen = []
+        image = self.capture_image()
+        for key, centre, box in self.process_image(image):
+            bits = np.unpackbits((seen_keys ^ np.uint64(key)).view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+            if not np.any((bits <= max_bits) & (np.abs(seen_centres - centre) <= max_shift)):
+                new_books[f"Book {len(new_books) + 1}"] = self.encode_spine(image, box)
+                self._pending_seen.append((key, centre))
+        return new_books
+
+    def commit_seen(self):
+        # called once the update carrying these books has been delivered
+        if self._pending_seen:
+            self.seen.update(self._pending_seen)
+            self._pending_seen = []
+            self._save_seen()
 
 # Data models
-class MediaItem(BaseModel):
+class MediaItem(msgspec.Struct, omit_defaults=True):
     title: str
     creator: str
     type: str
     timestamp: datetime
+    image: Optional[bytes] = None  # JPEG, base64 in JSON
 
-class DailyUpdate(BaseModel):
+class DailyUpdate(msgspec.Struct):
     date: datetime
     new_items: List[MediaItem]
 
+class LLaMAItem(msgspec.Struct):
+    title: str
+    creator: str
+    type: str
+    timestamp: str  # parsed with fromisoformat, since the model sometimes returns date-only values msgspec's RFC 3339 decoder rejects
+
+class LLaMAResponse(msgspec.Struct):
+    new_items: List[LLaMAItem]
+
+# Append-only ledger of every update (the .txt we used to keep, as fixed-size records)
+class MediaLedger:
+    RECORD = struct.Struct("<128sd")  # utf-8 title (NUL padded), POSIX timestamp of the run
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o600)
+        # drop a torn trailing record from an interrupted write so later appends stay aligned
+        size = os.fstat(self.fd).st_size
+        if size % self.RECORD.size:
+            os.ftruncate(self.fd, size - size % self.RECORD.size)
+        self.view = None
+        self._remap()
+
+    def close(self):
+        if self.view is not None:
+            self.view.close()
+            self.view = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def _remap(self):
+        if self.view is not None:
+            self.view.close()
+        size = os.fstat(self.fd).st_size
+        self.count = size // self.RECORD.size
+        self.view = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ) if size else None
+
+    def _record(self, i: int):
+        title, ts = self.RECORD.unpack_from(self.view, i * self.RECORD.size)
+        return title.rstrip(b"\0").decode("utf-8", "ignore"), ts
+
+    def last_update_time(self) -> Optional[datetime]:
+        if not self.count:
+            return None
+        return datetime.fromtimestamp(self._record(self.count - 1)[1])
+
+    def append(self, titles: List[str], when: datetime):
+        # an empty title marks a run that found nothing, so the run time is still recorded
+        ts = when.timestamp()
+        data = b"".join(self.RECORD.pack(title.encode("utf-8")[:128], ts) for title in titles or [""])
+        size = self.count * self.RECORD.size
+        written = os.write(self.fd, data)
+        if written != len(data):
+            os.ftruncate(self.fd, size)
+            raise OSError(f"short write to media ledger ({written} of {len(data)} bytes)")
+        self._remap()
+
+def make_session(retry_server_errors: bool = False) -> requests.Session:
+    # keep-alive pool so repeat POSTs skip the TCP/TLS handshake. Connection failures are always safe to retry;
+    # 5xx retries can resend a POST the backend already handled, so only callers that tolerate that opt in
+    if retry_server_errors:
+        retry = Retry(total=3, backoff_factor=0.5, status_forcelist=(502, 503, 504), allowed_methods=frozenset({"POST"}), raise_on_status=False)
+    else:
+        retry = Retry(total=3, connect=3, read=0, status=0, backoff_factor=0.5)
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=4, max_retries=retry))
+    return session
+
+def post_json(session: requests.Session, url: str, body: bytes, timeout: Tuple[float, float]) -> requests.Response:
+    # (connect, read) seconds; without a read timeout a stalled server hangs the run and retries never fire
+    return session.post(
+        url,
+        data=gzip.compress(body, compresslevel=6),
+        headers={"Content-Type": "application/json", "Content-Encoding": "gzip"},
+        timeout=timeout
+    )
+
 # LLaMA v3 Client
 class LLaMAv3Client:
     def __init__(self, server_url: str):
         self.server_url = server_url
+        self.session = make_session(retry_server_errors=True)
 
-    def process_data(self, data: Dict[str, Any], prompt: str) -> List[Dict[str, Any]]:
+    def process_data(self, data: Dict[str, Any], prompt: str) -> List[MediaItem]:
         payload = {
             "data": data,
             "prompt": prompt
         }
-        response = requests.post(f"{self.server_url}/process", json=payload)
+        body = msgspec.json.encode(payload)
+        # inference is slow, so give the read a generous budget
+        response = post_json(self.session, f"{self.server_url}/process", body, timeout=(5, 300))
         if response.status_code == 200:
-            return response.json()["new_items"]
+            return [
+                MediaItem(
+                    title=item.title,
+                    creator=item.creator,
+                    type=item.type,
+                    timestamp=datetime.fromisoformat(item.timestamp)
+                )
+                for item in msgspec.json.decode(response.content, type=LLaMAResponse).new_items
+            ]
         else:
             raise Exception(f"LLaMA v3 server error: {response.text}")
 
@@ -148,7 +370,16 @@ class MediaTracker:
         self.bookshelf_scanner = BookshelfScanner()
         self.llama_client = LLaMAv3Client("https://ajaymisra.com/llama")
         self.api_endpoint = "https://api.ajay.dog/media-updates"
-        self.last_update_time = datetime.now() - timedelta(days=1)
+        self.session = make_session()
+        self.ledger = MediaLedger(os.path.expanduser("~/.cache/media/ledger.bin"))
+        self.last_update_time = self.ledger.last_update_time() or datetime.now() - timedelta(days=1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.bookshelf_scanner.release()
+        self.ledger.close()
 
     def get_new_audiobooks(self) -> List[MediaItem]:
         library = self.audible.get_user_library()
@@ -176,24 +407,31 @@ class MediaTracker:
 
     def get_new_physical_books(self) -> List[MediaItem]:
         new_books = self.bookshelf_scanner.get_new_books()
+        now = datetime.now()
         return [
             MediaItem(
                 title=title,
                 creator="Unknown",
                 type="physical_book",
-                timestamp=datetime.now()
+                timestamp=now,
+                image=image
             )
-            for title in new_books
+            for title, image in new_books.items()
         ]
 
     def collect_new_data(self) -> Dict[str, List[MediaItem]]:
-        return {
-            "audiobooks": self.get_new_audiobooks(),
-            "music": self.get_new_music(),
-            "physical_books": self.get_new_physical_books()
-        }
-
-    def process_with_llama(self, data: Dict[str, List[MediaItem]]) -> List[Dict[str, Any]]:
+        # network scrapes and the camera/OpenCV work all release the GIL, so threads overlap them fine
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            audiobooks = executor.submit(self.get_new_audiobooks)
+            music = executor.submit(self.get_new_music)
+            physical_books = executor.submit(self.get_new_physical_books)
+            return {
+                "audiobooks": audiobooks.result(),
+                "music": music.result(),
+                "physical_books": physical_books.result()
+            }
+
+    def process_with_llama(self, data: Dict[str, List[MediaItem]]) -> List[MediaItem]:
         prompt = """
         Given the list of new items in the user's media collection (audiobooks, music, and physical books),
         please identify and return only the new items that have been added since the last update.
@@ -202,46 +440,58 @@ class MediaTracker:
         return self.llama_client.process_data(data, prompt)
 
     def generate_daily_update(self) -> DailyUpdate:
+        # taken before collecting: this becomes the next run's cutoff, so anything added while we collect/infer is picked up then
+        now = datetime.now()
         new_data = self.collect_new_data()
-        processed_data = self.process_with_llama(new_data)
-        
-        new_items = [
-            MediaItem(
-                title=item["title"],
-                creator=item["creator"],
-                type=item["type"],
-                timestamp=datetime.fromisoformat(item["timestamp"])
-            )
-            for item in processed_data
-        ]
+        if any(new_data.values()):
+            new_items = self.process_with_llama(new_data)
+        else:
+            # nothing new from any source, so there's nothing for LLaMA to do; the empty update still goes out as a heartbeat
+            new_items = []
         
         update = DailyUpdate(
-            date=datetime.now(),
+            date=now,
             new_items=new_items
         )
-        
-        self.last_update_time = datetime.now()
         return update
 
-    def send_update_to_api(self, update: DailyUpdate):
-        response = requests.post(
-            self.api_endpoint,
-            json=update.dict(),
-            headers={"Content-Type": "application/json"}
-        )
+    def record_update(self, update: DailyUpdate):
+        # only called once the update has been delivered, so a failed send is retried on the next run
+        self.ledger.append([item.title for item in update.new_items], update.date)
+        self.last_update_time = update.date
+        self.bookshelf_scanner.commit_seen()
+
+    def send_update_to_api(self, update: DailyUpdate) -> bool:
+        # a read timeout here isn't retried (read=0 in make_session), since the backend may have stored the update
+        response = post_json(self.session, self.api_endpoint, msgspec.json.encode(update), timeout=(5, 30))
         if response.status_code != 200:
             print(f"Failed to send update: {response.text}")
+            return False
+        return True
+
+    def run_once(self):
+        try:
+            update = self.generate_daily_update()
+            if self.send_update_to_api(update):
+                self.record_update(update)
+                print(f"Daily update sent successfully. New items: {[item.title for item in update.new_items]}")
+        except Exception as e:
+            print(f"Error during daily update: {str(e)}")
+        finally:
+            self.bookshelf_scanner.release()
 
     def run_daily(self):
         while True:
-            try:
-                update = self.generate_daily_update()
-                self.send_update_to_api(update)
-                print(f"Daily update sent successfully. New items: {[item.title for item in update.new_items]}")
-            except Exception as e:
-                print(f"Error during daily update: {str(e)}")
+            self.run_once()
             time.sleep(86400)  
 
 if __name__ == "__main__":
-    tracker = MediaTracker()
-    tracker.run_daily()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--once", action="store_true", help="run a single update and exit (for cron / systemd timers)")
+    args = parser.parse_args()
+
+    with MediaTracker() as tracker:
+        if args.once:
+            tracker.run_once()
+        else:
+            tracker.run_daily()